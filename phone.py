@@ -1,12 +1,124 @@
 #!/usr/bin/env python3
+import ctypes
 import datetime
-from xmlrpc.server import DocXMLRPCServer
+import hashlib
+import os
+from xmlrpc.server import DocXMLRPCServer, DocXMLRPCRequestHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import socket
+import socketserver
+import threading
+import urllib.parse
+import collections
+import concurrent.futures
+import mmap
+import operator
+import xmlrpc.client
 
 import time
 
+# Size of the slices in which asset data is read and transferred.
+CHUNK_SIZE = 1 << 20
+
+# Upper bound on the in memory asset data we keep around for subsequent chunk requests. Handles are
+# dropped as soon as their data has been sent in full, so this only has to hold the assets that are
+# being transferred at the same time. Loading the next asset ahead may exceed it by one asset.
+HANDLE_CACHE_BYTES = 256 << 20
+
+# Seconds to wait for PhotoKit to hand over a video.
+VIDEO_REQUEST_TIMEOUT = 30
+
+# PHAssetResourceType of an edited photo as rendered and of the original photo.
+PHASSET_RESOURCE_TYPE_FULL_SIZE_PHOTO = 5
+PHASSET_RESOURCE_TYPE_PHOTO = 1
+
+# Attributes that make up the serialized form of photos' types, the RECURSE keys hold values that
+# need to be converted themselves.
+ASSETCOLLECTION_DATA_KEYS = ("local_id",
+                             "assets",
+                             "title",
+                             "type",
+                             "subtype",
+                             "start_date",
+                             "end_date")
+ASSETCOLLECTION_RECURSE_KEYS = ("assets", "start_date", "end_date")
+_ASSETCOLLECTION_GETTER = operator.attrgetter(*ASSETCOLLECTION_DATA_KEYS)
+
+ASSET_DATA_KEYS = ("local_id",
+                   "pixel_width",
+                   "pixel_height",
+                   "media_type",
+                   "media_subtypes",
+                   "creation_date",
+                   "modification_date",
+                   "hidden",
+                   "favorite",
+                   "duration",
+                   "location")
+ASSET_RECURSE_KEYS = ("creation_date", "modification_date", "location")
+_ASSET_GETTER = operator.attrgetter(*ASSET_DATA_KEYS)
+
+
+from objc_util import ObjCInstance, ObjCClass, ObjCBlock, c_void_p
+
+class AssetData:
+    """
+        Holds the data of a single asset, allows reading slices from it without materializing the
+        entire file as one Python bytes object.
+    """
+    def __init__(self, buffer, size, in_memory, owner=None, fp=None, path=None):
+        self.buffer = buffer
+        self.size = size
+        # File holding the data, if it is backed by one.
+        self.path = path
+        # Number of bytes this handle keeps alive in memory, mmap'd files don't count.
+        self.in_memory = in_memory
+        # Object that owns the memory the buffer points into, must outlive the buffer.
+        self.owner = owner
+        self.fp = fp
+
+        # Running md5 over the data read so far, as long as it is read in order from the start.
+        # Only used as a checksum, this allows OpenSSL to skip its FIPS checks.
+        self.md5 = hashlib.new("md5", usedforsecurity=False)
+        self.hashed = 0
+
+    def _slice(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        return self.buffer[offset:end]
+
+    def _hash(self, offset, data):
+        if offset == self.hashed:
+            self.md5.update(data)
+            self.hashed += len(data)
+
+    def read(self, offset, length):
+        """
+            Return the bytes in [offset, offset + length), truncated at the end of the data.
+        """
+        data = self._slice(offset, length)
+        self._hash(offset, data)
+        return bytes(data)
+
+    def md5_hexdigest(self):
+        """
+            Return the md5 of the data, only the part that hasn't been read in order is hashed.
+        """
+        for offset in range(self.hashed, self.size, CHUNK_SIZE):
+            self._hash(offset, self._slice(offset, CHUNK_SIZE))
+        return self.md5.hexdigest()
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self.fp is not None:
+            self.fp.close()
+        self.buffer = None
+        self.owner = None
+        self.fp = None
+
 
-from objc_util import ObjCInstance
 class PhotoService:
     """
         Class to expose the photos module through an xml rpc interface.
@@ -15,6 +127,27 @@ class PhotoService:
         # Use a local instance instance of photos in case we ever want to hook methods.
         import photos
         self.p = photos
+        # Data handles by local_id, in least recently used order, such that chunked retrieval
+        # doesn't need to go through PhotoKit for every chunk.
+        self._handles = collections.OrderedDict()
+        # The handles are shared between the xmlrpc server and the data server threads.
+        self._handles_lock = threading.RLock()
+        # Futures of the handles that are being loaded outside of the lock, by local_id.
+        self._loading = {}
+        # Futures of the _filesize and _md5 of assets whose data has been sent in full, by local_id.
+        self._digests = {}
+        # The local_id prepared after each local_id, such that sending an asset can start loading
+        # the next one on the warmer thread.
+        self._upcoming = {}
+        self._last_prepared = None
+        self._warmer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Serialization functions by exact type, anything else is returned as is.
+        self._serializers = {
+            list: self._serialize_list,
+            self.p.AssetCollection: self._serialize_asset_collection,
+            self.p.Asset: self._serialize_asset,
+            datetime.datetime: self._serialize_datetime,
+        }
         """
         # This wasn't too useful, can't marshall the types.
         for z in dir(photos):
@@ -23,15 +156,31 @@ class PhotoService:
             setattr(self, z, getattr(photos, z))
         """
 
+    def _get_all_assets(self):
+        all_assets = self.p.get_assets(media_type="image")
+        all_assets.extend(list(self.p.get_assets(media_type="video")))
+        return all_assets
+
     def get_all_metadata(self):
         """
             Retrieve all metadata of all images and videos.
         """
-        all_assets = self.p.get_assets(media_type="image")
-        all_assets.extend(list(self.p.get_assets(media_type="video")))
-        flat = [self._make_serializable(z) for z in all_assets]
+        flat = [self._make_serializable(z) for z in self._get_all_assets()]
         return flat
 
+    def list_ids_and_mtimes(self):
+        """
+            Retrieve (local_id, modification_date) of all images and videos, this is much cheaper
+            than get_all_metadata and allows the client to only request what changed.
+        """
+        return [(a.local_id, self._make_serializable(a.modification_date)) for a in self._get_all_assets()]
+
+    def get_metadata_by_local_ids(self, local_ids):
+        """
+            Retrieve the metadata of the assets with these local ids, without touching their data.
+        """
+        return [self._make_serializable(self.p.get_asset_with_local_id(local_id)) for local_id in local_ids]
+
     def get_asset_collections(self):
         """
             Get all asset collections.
@@ -47,27 +196,37 @@ class PhotoService:
                         }
         return assetcollections
 
-    def delete_assets_by_metadata(self, list_of_asset_metadata, ignore_integrity=False):
+    def delete_assets_by_metadata(self, list_of_asset_metadata, ignore_integrity=False, metadata_only=False):
         """
             Remove list of assets. Metadata provides strong guarantees that the asset was correctly
-            transfered.
+            transfered. With metadata_only the md5 of the data is not verified, only its size, such
+            that the data of the assets doesn't need to be loaded or hashed.
         """
         to_delete = []
 
         for metadata in list_of_asset_metadata:
             local_id = metadata["local_id"]
-            on_phone_metadata = self.retrieve_asset_by_local_id(local_id)
-            # Discard the data key.
-            del on_phone_metadata["_data"]
+            asset = self.p.get_asset_with_local_id(local_id)
+            on_phone_metadata = self._make_serializable(asset)
+            if metadata_only:
+                # The size is still required, it proves the client has the data at all.
+                metadata = {k: v for k, v in metadata.items() if not k.startswith("_") or k == "_filesize"}
+                if on_phone_metadata.items() <= metadata.items():
+                    on_phone_metadata["_filesize"] = self._get_size(local_id, asset)
+            elif on_phone_metadata.items() <= metadata.items():
+                # Only read the data if the metadata matches.
+                on_phone_metadata.update(self._size_and_md5(local_id, asset))
+                self.release_asset(local_id)
+
             if on_phone_metadata == metadata:
-                to_delete.append(self.p.get_asset_with_local_id(local_id))
+                to_delete.append(asset)
             else:
                 print("Something is not matching:")
                 print("   Metadata Phone: {}".format(on_phone_metadata))
                 print("   Metadata Local: {}".format(metadata))
                 if ignore_integrity:
                     print("Deleting regardless, as integrity check passed.");
-                    to_delete.append(self.p.get_asset_with_local_id(local_id))
+                    to_delete.append(asset)
                 else:
                     print("Integrity check required to pass, aborting.")
                     return
@@ -75,6 +234,22 @@ class PhotoService:
         print(to_delete)
         self.p.batch_delete(to_delete)
 
+    def _get_size(self, local_id, asset):
+        """
+            Return the size of an asset's data, the data is only loaded if PhotoKit doesn't report
+            the size of an image.
+        """
+        if asset.media_type == "video":
+            return self._get_video_path(asset)[1]
+        try:
+            size = self._get_image_size(asset)
+        except Exception:
+            size = None
+        if size is None:
+            size = self._get_handle(local_id, asset).size
+            self.release_asset(local_id)
+        return size
+
     @staticmethod
     def _asset_filename(a):
         return str(ObjCInstance(a).filename())
@@ -82,33 +257,113 @@ class PhotoService:
 
     @staticmethod
     def _get_data(asset):
+        """
+            Return an AssetData handle to the data of an asset.
+        """
         if (asset.media_type == "image"):
             # image_b = asset.get_image_data(original=True)
             # print(image_b.uti)
             # image_bytes = image_b.getvalue()
             return PhotoService._get_image_data(asset)
         if (asset.media_type == "video"):
-            image_b = PhotoService._get_video_data(asset)
-            image_bytes = image_b
-        return image_bytes
+            return PhotoService._get_video_data(asset)
+
 
+    @staticmethod
+    def _get_image_size(asset):
+        """
+            Return the size of the image data from the asset resource of its current version,
+            without loading it. None if PhotoKit doesn't report it.
+        """
+        resources = ObjCClass('PHAssetResource').assetResourcesForAsset_(asset)
+        sizes = {}
+        for i in range(resources.count()):
+            resource = resources.objectAtIndex_(i)
+            sizes[resource.type()] = resource.valueForKey_('fileSize')
+
+        # An edited photo is retrieved as rendered, that is its full size photo resource.
+        size = sizes.get(PHASSET_RESOURCE_TYPE_FULL_SIZE_PHOTO, sizes.get(PHASSET_RESOURCE_TYPE_PHOTO))
+        if size is None:
+            return None
+        return int(size.longLongValue())
 
     @staticmethod
     def _get_video_data(asset):
+        """
+            Return an AssetData handle to the video, the file is mapped instead of read, this way
+            only the pages backing the chunks that are requested get paged in.
+        """
+        path, size = PhotoService._get_video_path(asset)
+        fp = open(path, 'rb')
+        if size == 0:
+            return AssetData(b"", 0, in_memory=0, fp=fp, path=path)
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return AssetData(mapped, size, in_memory=0, fp=fp, path=path)
+
+    # The PhotoKit objects used for requests are the same for every asset, only create them once.
+    _image_manager = None
+    _image_request_options = None
+    _video_request_options = None
+    _image_handler = threading.local()
+
+    @staticmethod
+    def _get_image_manager():
+        """
+            Return the PHImageManager, creating it and the request options on first use.
+        """
+        if PhotoService._image_manager is None:
+            image_options = ObjCClass('PHImageRequestOptions').new()
+            image_options.PHImageRequestOptionsDeliveryMode = 1 # high quality
+            image_options.version = 0
+            image_options.synchronous = True
+            PhotoService._image_request_options = image_options
+
+            video_options = ObjCClass('PHVideoRequestOptions').new()
+            video_options.version = 1	#PHVideoRequestOptionsVersionOriginal, use 0 for edited versions.
+            PhotoService._video_request_options = video_options
+
+            PhotoService._image_manager = ObjCClass('PHImageManager').defaultManager()
+        return PhotoService._image_manager
+
+    @staticmethod
+    def _get_image_handler():
+        """
+            Return this thread's result handler for image requests. Those are synchronous, the
+            handler runs on the requesting thread so the block can be reused for every request.
+        """
+        handler = PhotoService._image_handler
+        if not hasattr(handler, "block"):
+            handler.handled_assets = []
+
+            def handleAsset(_obj, result, info):
+                # result here holds the thing we actually want.
+                A = ObjCInstance(result)
+                handler.handled_assets.append(A)
+
+            handler.block = ObjCBlock(handleAsset, argtypes=[c_void_p,]*3)
+        return handler
+
+    @staticmethod
+    def _get_video_path(asset):
+        """
+            Return (path, size) of the file holding the original video.
+        """
         # https://forum.omz-software.com/topic/3299/get-filenames-for-photos-from-camera-roll/18
         # https://gist.github.com/jsbain/de01d929d3477a4c8e7ae9517d5b3d70
-        from objc_util import ObjCInstance, ObjCClass, ObjCBlock, c_void_p
         assets = [asset]
-        options = ObjCClass('PHVideoRequestOptions').new()
-        options.version = 1	#PHVideoRequestOptionsVersionOriginal, use 0 for edited versions.
-        image_manager = ObjCClass('PHImageManager').defaultManager()
+        image_manager = PhotoService._get_image_manager()
+        options = PhotoService._video_request_options
 
+        # The handler is called on another thread, so this block can't be shared between calls.
         handled_assets = []
+        all_handled = threading.Event()
 
         def handleAsset(_obj,asset, audioMix, info):
             A = ObjCInstance(asset)
             '''I am just appending to handled_assets to process later'''
             handled_assets.append(A)
+            if len(handled_assets) == len(assets):
+                all_handled.set()
             '''
             # alternatively, handle inside handleAsset.  maybe need a threading.Lock here to ensure you are not sending storbinaries in parallel
             with open(str(A.resolvedURL().resourceSpecifier()),'rb') as fp:
@@ -122,13 +377,14 @@ class PhotoService:
             image_manager.requestAVAssetForVideo(A, 
                                 options=options, 
                                 resultHandler=handlerblock)
-                                
-        while len(handled_assets) < len(assets):
-            time.sleep(0.1)
+
+        # The handler is called from another thread, wake up as soon as it has been called.
+        if not all_handled.wait(timeout=VIDEO_REQUEST_TIMEOUT):
+            raise TimeoutError(f"Video request not handled within {VIDEO_REQUEST_TIMEOUT} seconds.")
 
         A = handled_assets[0]
-        with open(str(A.resolvedURL().resourceSpecifier()),'rb') as fp:
-            return fp.read()
+        path = str(A.resolvedURL().resourceSpecifier())
+        return path, os.stat(path).st_size
 
 
     @staticmethod
@@ -136,61 +392,214 @@ class PhotoService:
         # adapted from get_video_data
         # https://forum.omz-software.com/topic/3299/get-filenames-for-photos-from-camera-roll/18
         # https://gist.github.com/jsbain/de01d929d3477a4c8e7ae9517d5b3d70
-        import objc_util
-        from objc_util import ObjCInstance, ObjCClass, ObjCBlock, c_void_p
-        import ctypes
         assets = [asset]
-        options = ObjCClass('PHImageRequestOptions').new()
-        options.PHImageRequestOptionsDeliveryMode = 1 # high quality
-        options.version = 0
-        options.synchronous = True
-        image_manager = ObjCClass('PHImageManager').defaultManager()
-
-        handled_assets = []
-
-        def handleAsset(_obj, result, info):
-            # result here holds the thing we actually want.
-            A = ObjCInstance(result)
-            handled_assets.append(A)
-
-        handlerblock=ObjCBlock(handleAsset, argtypes=[c_void_p,]*3)
+        image_manager = PhotoService._get_image_manager()
+        options = PhotoService._image_request_options
+        handler = PhotoService._get_image_handler()
+        handled_assets = handler.handled_assets
+        handled_assets.clear()
+        handlerblock = handler.block
 
         for A in assets:
             # https://developer.apple.com/documentation/photokit/phimagemanager/3237282-requestimagedataandorientationfo?language=objc
             image_manager.requestImageDataAndOrientationForAsset(A,options=options, 
                                 resultHandler=handlerblock)
-                                
-        while len(handled_assets) < len(assets):
-            # print(".");
-            time.sleep(0.1)
-
-        # Now we have some clunky bytes object that makes up a pointer and a length, retrieve the
-        # heic data.
-        retrieved_data = handled_assets[0]
+
+        # The request is synchronous, the handler has been called by the time it returns so there
+        # is nothing to wait for.
+
+        # Now we have some clunky bytes object that makes up a pointer and a length, view the heic
+        # data in place through a memoryview, slicing that copies at C speed instead of going byte
+        # by byte. The NSData owns the memory, so the handle keeps it alive.
+        retrieved_data = handled_assets.pop()
         ptr = retrieved_data.bytes()
-        data = ctypes.POINTER(ctypes.c_char).from_buffer(ptr)[:retrieved_data.length()]
+        length = retrieved_data.length()
+        if length == 0:
+            return AssetData(b"", 0, in_memory=0)
+        data = memoryview((ctypes.c_ubyte * length).from_address(ptr.value)).cast("B")
 
-        return data
+        return AssetData(data, length, in_memory=length, owner=retrieved_data)
 
-    def retrieve_asset_by_local_id(self, local_id):
+    def _get_handle(self, local_id, asset=None, keep=1):
         """
-            Function to retrieve an asset by its local id, with full metdata and the extra keys:
+            Return the data handle for this local_id, loading it if it isn't cached. The asset
+            can be passed if it has already been looked up. The data is loaded outside of the
+            lock and only once if it is requested concurrently, so this must not be called while
+            holding the lock. After loading, the keep most recently used handles aren't evicted.
+        """
+        with self._handles_lock:
+            handle = self._handles.get(local_id)
+            if handle is not None:
+                self._handles.move_to_end(local_id)
+                return handle
+            loading = self._loading.get(local_id)
+            if loading is not None:
+                # Another thread is loading it already, wait for that.
+                load = False
+            else:
+                loading = self._loading[local_id] = concurrent.futures.Future()
+                load = True
+        if not load:
+            return loading.result()
+
+        try:
+            if asset is None:
+                asset = self.p.get_asset_with_local_id(local_id)
+            handle = self._get_data(asset)
+        except BaseException as e:
+            with self._handles_lock:
+                del self._loading[local_id]
+            loading.set_exception(e)
+            raise
+
+        with self._handles_lock:
+            del self._loading[local_id]
+            self._handles[local_id] = handle
+
+            # Evict the least recently used handles, but always keep the one we just loaded.
+            while len(self._handles) > keep and sum(h.in_memory for h in self._handles.values()) > HANDLE_CACHE_BYTES:
+                _, evicted = self._handles.popitem(last=False)
+                evicted.close()
+        loading.set_result(handle)
+        return handle
+
+    def _with_handle(self, local_id, f, asset=None):
+        """
+            Return f(handle) for the data handle of this local_id, the handle can't be evicted
+            while f runs.
+        """
+        while True:
+            handle = self._get_handle(local_id, asset)
+            with self._handles_lock:
+                # It may have been evicted since it was returned, while we hold the lock it can't be.
+                if self._handles.get(local_id) is handle:
+                    return f(handle)
+
+    def _read_asset(self, local_id, offset, length):
+        """
+            Read a slice of an asset's data.
+        """
+        return self._with_handle(local_id, lambda handle: handle.read(offset, length))
+
+    def _asset_size_and_path(self, local_id):
+        """
+            Return (size, path) of an asset's data, path is None if it isn't backed by a file.
+        """
+        handle = self._get_handle(local_id)
+        return handle.size, handle.path
+
+    def _warm_next(self, local_id):
+        """
+            Start loading the data of the asset prepared after this one on the warmer thread, such
+            that it is loaded while this one is being sent and written by the client.
+        """
+        with self._handles_lock:
+            next_id = self._upcoming.pop(local_id, None)
+        if next_id is not None:
+            # Don't evict the one that is being sent for it.
+            self._warmer.submit(self._get_handle, next_id, keep=2)
+
+    def release_asset(self, local_id):
+        """
+            Drop the data of this asset that is held for chunked retrieval.
+        """
+        with self._handles_lock:
+            self._digests.pop(local_id, None)
+            self._upcoming.pop(local_id, None)
+            handle = self._handles.pop(local_id, None)
+            if handle is not None:
+                handle.close()
+
+    def _finish_asset(self, local_id):
+        """
+            Called once the data of an asset has been sent in full, computes its _filesize and _md5
+            for finalize_many_retrievals and drops the data right away.
+        """
+        with self._handles_lock:
+            handle = self._handles.pop(local_id, None)
+            if handle is None:
+                return
+            digest = self._digests[local_id] = concurrent.futures.Future()
+
+        # Hash outside of the lock, for a video this reads the remainder of the file.
+        try:
+            digest.set_result({"_filesize": handle.size, "_md5": handle.md5_hexdigest()})
+        except Exception as e:
+            digest.set_exception(e)
+        finally:
+            handle.close()
+
+    def _retrieve_asset_metadata_by_local_id(self, local_id):
+        """
+            Function to retrieve an asset's metadata by its local id, with the extra keys:
             - _filesize the number of bytes making up the file
-            - _data The data of this file.
             - _md5 The md5 sum of this file.
+            The data is kept available for the data server.
         """
+        # Always start from fresh data, the asset may have been modified since last retrieval.
+        self.release_asset(local_id)
         asset = self.p.get_asset_with_local_id(local_id)
 
         asset_dict = self._make_serializable(asset)
-        image_bytes = self._get_data(asset)
-        asset_dict["_filesize"] = len(image_bytes)
-        asset_dict["_data"] = image_bytes
-        
-        import hashlib
-        m = hashlib.md5()
-        m.update(image_bytes)
-        asset_dict["_md5"] = m.hexdigest()
+        asset_dict.update(self._size_and_md5(local_id, asset))
+        return asset_dict
+
+    def _size_and_md5(self, local_id, asset=None):
+        """
+            Return a dict with the _filesize and _md5 of an asset's data.
+        """
+        return self._with_handle(local_id, lambda handle: {"_filesize": handle.size, "_md5": handle.md5_hexdigest()}, asset)
 
+    def prepare_many_retrievals(self, local_ids):
+        """
+            Start retrieving these assets, returns their metadata. The data of each asset is
+            loaded once the one prepared before it is requested from the data server, the
+            _filesize and _md5 are computed as it is sent, finalize_many_retrievals returns those.
+        """
+        prepared = []
+        for local_id in local_ids:
+            # Always start from fresh data, the asset may have been modified since last retrieval.
+            self.release_asset(local_id)
+            prepared.append(self._make_serializable(self.p.get_asset_with_local_id(local_id)))
+
+        # The client retrieves them in this order, following the ones prepared before.
+        with self._handles_lock:
+            previous = self._last_prepared
+            for local_id in local_ids:
+                if previous is not None:
+                    self._upcoming[previous] = local_id
+                previous = local_id
+            self._last_prepared = previous
+        return prepared
+
+    def finalize_many_retrievals(self, local_ids):
+        """
+            Return the _filesize and _md5 of each of these assets whose data has been read, in the
+            same order, and release them.
+        """
+        final = []
+        for local_id in local_ids:
+            with self._handles_lock:
+                digest = self._digests.pop(local_id, None)
+            if digest is None:
+                # Not sent in full by the data server, hash whatever the handle holds.
+                final.append(self._size_and_md5(local_id))
+                self.release_asset(local_id)
+                continue
+            final.append(digest.result())
+        return final
+
+    def retrieve_asset_by_local_id(self, local_id):
+        """
+            Function to retrieve an asset by its local id, with full metdata and the extra keys:
+            - _filesize the number of bytes making up the file
+            - _data The data of this file.
+            - _md5 The md5 sum of this file.
+            This holds the entire file in memory, use the data server for large files.
+        """
+        asset_dict = self._retrieve_asset_metadata_by_local_id(local_id)
+        asset_dict["_data"] = self._read_asset(local_id, 0, asset_dict["_filesize"])
+        self.release_asset(local_id)
         return asset_dict
 
 
@@ -199,71 +608,167 @@ class PhotoService:
             This function can convert any photos' data type into a dictionary
             of usefulness.
         """
-        ASSETCOLLECTION_DATA_KEYS = ("local_id",
-                                     "assets",
-                                     "title",
-                                     "type",
-                                     "subtype",
-                                     "start_date",
-                                     "end_date")
-        ASSET_DATA_KEYS = ("local_id",
-                           "pixel_width",
-                           "pixel_height",
-                           "media_type",
-                           "media_subtypes",
-                           "creation_date",
-                           "modification_date",
-                           "hidden",
-                           "favorite",
-                           "duration",
-                           "location")
-        if isinstance(a, list):
-            z = [self._make_serializable(b) for b in a]
-            return z
-            
-        if isinstance(a, self.p.AssetCollection):
-            z = {}
-            for k in ASSETCOLLECTION_DATA_KEYS:
-                z[k] = self._make_serializable(getattr(a, k))
-            return z
-
-        if isinstance(a, self.p.Asset):
-            z = {}
-            for k in ASSET_DATA_KEYS:
-                z[k] = self._make_serializable(getattr(a, k))
-            z["filename"] = PhotoService._asset_filename(a)
-            return z
-            
+        serialize = self._serializers.get(type(a))
+        if serialize is None:
+            # we do not need to recurse / modify, return as is.
+            return a
+        return serialize(a)
+
+    def _serialize_list(self, a):
+        return [self._make_serializable(b) for b in a]
+
+    def _serialize_asset_collection(self, a):
+        z = dict(zip(ASSETCOLLECTION_DATA_KEYS, _ASSETCOLLECTION_GETTER(a)))
+        for k in ASSETCOLLECTION_RECURSE_KEYS:
+            z[k] = self._make_serializable(z[k])
+        return z
+
+    def _serialize_asset(self, a):
+        z = dict(zip(ASSET_DATA_KEYS, _ASSET_GETTER(a)))
+        for k in ASSET_RECURSE_KEYS:
+            z[k] = self._make_serializable(z[k])
+        z["filename"] = PhotoService._asset_filename(a)
+        return z
 
-        if isinstance(a, datetime.datetime):
-            return time.mktime(a.timetuple())
+    @staticmethod
+    def _serialize_datetime(a):
+        return time.mktime(a.timetuple())
 
-        # we do not need to recurse / modify, return as is.
-        return a
 
+class PhotoRequestHandler(DocXMLRPCRequestHandler):
+    """
+        Request handler that gzips large responses and accepts gzipped requests of any size.
+    """
+    # Keep the connection open between calls, saves a tcp handshake per call.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without this Nagle holds back the body on a kept
+    # alive connection until the client's delayed ack arrives.
+    disable_nagle_algorithm = True
+
+    # Responses larger than this are gzipped if the client accepts that, metadata compresses well.
+    encode_threshold = 1400
+
+    def decode_request_content(self, data):
+        # The base class refuses gzipped requests that decode to more than 20 MiB, the deletion
+        # proof of a large library can be bigger than that.
+        if self.headers.get("content-encoding", "identity").lower() == "gzip":
+            try:
+                return xmlrpc.client.gzip_decode(data, max_decode=-1)
+            except ValueError:
+                pass
+        return super().decode_request_content(data)
+
+class ReuseableDocXMLServer(socketserver.ThreadingMixIn, DocXMLRPCServer):
+    # Each client thread keeps its own connection open, so serve each on its own thread.
+    daemon_threads = True
 
-class ReuseableDocXMLServer(DocXMLRPCServer):
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
 
+class AssetDataRequestHandler(BaseHTTPRequestHandler):
+    """
+        Serves the raw data of assets, without the base64 and xml overhead of xmlrpc:
+            GET /asset/<quoted local_id>?offset=<offset>&length=<length>
+        Both offset and length are optional, by default the entire file is returned.
+    """
+    protocol_version = "HTTP/1.1"
+    # Same as for the xmlrpc handler, don't let Nagle stall every response on delayed acks.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.startswith("/asset/"):
+            self.send_error(404)
+            return
+        local_id = urllib.parse.unquote(url.path[len("/asset/"):])
+        query = urllib.parse.parse_qs(url.query)
+        service = self.server.service
+
+        try:
+            offset = int(query.get("offset", [0])[0])
+            length = int(query["length"][0]) if "length" in query else None
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if offset < 0 or (length is not None and length < 0):
+            self.send_error(400, "offset and length can't be negative")
+            return
+
+        try:
+            size, path = service._asset_size_and_path(local_id)
+        except Exception as e:
+            self.send_error(404, str(e))
+            return
+
+        offset = min(offset, size)
+        length = size - offset if length is None else min(length, size - offset)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        if offset == 0:
+            # Load the next asset while this one is being sent.
+            service._warm_next(local_id)
+
+        if path is not None:
+            # Let the kernel copy the file to the socket, it uses sendfile where available. Use a
+            # file of our own, the handle may be evicted while this is being sent. A count of
+            # zero is refused by sendfile, so an empty range is skipped.
+            if length:
+                with open(path, "rb") as f:
+                    self.connection.sendfile(f, offset, length)
+        else:
+            # Write in chunks, such that the other server isn't blocked for the entire transfer.
+            position = offset
+            while position < offset + length:
+                chunk = service._read_asset(local_id, position, min(CHUNK_SIZE, offset + length - position))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                position += len(chunk)
+
+        if offset + length == size:
+            # Everything up to the end has been sent, the data isn't needed anymore.
+            service._finish_asset(local_id)
+
+
+class AssetDataServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, service):
+        super().__init__(server_address, AssetDataRequestHandler)
+        self.service = service
+
+
 def disable_idle():
     from objc_util import on_main_thread
     import console
     on_main_thread(console.set_idle_timer_disabled)(True);
 
 def start():
-    with ReuseableDocXMLServer(("0.0.0.0", 1338), allow_none=True) as server:
+    with ReuseableDocXMLServer(("0.0.0.0", 1338), requestHandler=PhotoRequestHandler, allow_none=True) as server:
         server.set_server_title("Photo management server")
         server.set_server_name("Photo management server")
 
-        server.register_instance(PhotoService(), allow_dotted_names=True)
-        #server.register_multicall_functions()
+        service = PhotoService()
+        server.register_instance(service, allow_dotted_names=True)
+        server.register_multicall_functions()
+
+        data_server = AssetDataServer(("0.0.0.0", 1339), service)
+        threading.Thread(target=data_server.serve_forever, daemon=True).start()
+        print('Serving asset data on localhost port 1339')
+
         print('Serving XML-RPC on localhost port 1338')
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             print("\nKeyboard interrupt received, exiting.")
+        finally:
+            data_server.shutdown()
+            data_server.server_close()
 
 def test_image_data():
     p = PhotoService()
@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 import argparse
 import xmlrpc.client
+import http.client
+import urllib.parse
 
 import os
+import re
 import json
+import hashlib
+import collections
+import itertools
+import contextlib
+import functools
+import string
+import threading
+import queue
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import datetime
 import time
@@ -11,160 +24,576 @@ from pathlib import Path
 
 import logging
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger('Sync')
 
+# Size of the slices in which asset data is retrieved from the phone.
+CHUNK_SIZE = 1 << 20
+
+# Port the phone serves the asset data on, next to the xmlrpc interface.
+DATA_PORT = 1339
+
+# Number of received chunks that may be queued up ahead of the disk writes.
+READ_AHEAD_CHUNKS = 4
+
+# Number of threads used to probe the metadata files on disk.
+PROBE_WORKERS = 32
+
+# Name of the index of synced assets, stored in the root of the storage directory.
+INDEX_FILENAME = ".sync_index.json"
+
+# Matches the modification date at the start of a metadata file.
+MODIFICATION_DATE_PREFIX = re.compile(rb'\{"modification_date":\s*(-?[0-9][0-9.eE+-]*)\s*[,}]')
+
+def loads_json(data):
+    """
+        Parse json from bytes or str, using orjson if it is available.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj):
+    """
+        Serialize to json as utf-8 bytes, using orjson if it is available.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def load_json(path):
+    with open(path, "rb") as f:
+        return loads_json(f.read())
+
+def dump_json(path, obj):
+    with open(path, "wb") as f:
+        f.write(dumps_json(obj))
+
+def md5_of_file(f):
+    """
+        Return the hex md5 of an opened binary file, hashing in C without holding the whole file.
+    """
+    if hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(f, "md5").hexdigest()
+
+    # Python < 3.11, feed it in chunks ourselves.
+    m = hashlib.md5()
+    while chunk := f.read(CHUNK_SIZE):
+        m.update(chunk)
+    return m.hexdigest()
+
+@functools.lru_cache(maxsize=1 << 16)
+def path_date_keys(creation_date, modification_date):
+    """
+        Return the year and month keys available to the path formats for these dates.
+    """
+    z = {}
+    for (suffix, timestamp) in (("create", creation_date), ("mod", modification_date)):
+        # Only year and month are needed, no need to go through strftime for those.
+        tm = time.gmtime(timestamp)
+        z["Y_" + suffix] = f"{tm.tm_year:04d}"
+        z["m_" + suffix] = f"{tm.tm_mon:02d}"
+    return z
+
+def compile_format(fmt):
+    """
+        Return a function that formats fmt with the keys of a dict, parsing fmt only once. Plain
+        {key} fields are substituted directly, anything fancier falls back to str.format.
+    """
+    parts = list(string.Formatter().parse(fmt))
+    if any(field is not None and (spec or conversion or not field.isidentifier())
+           for _, field, spec, conversion in parts):
+        return lambda m: fmt.format(**m)
+
+    def format_fields(m):
+        return "".join(literal if field is None else literal + format(m[field], "")
+                       for literal, field, _, _ in parts)
+    return format_fields
+
+class GzipTransport(xmlrpc.client.Transport):
+    """
+        Transport that gzips large requests, such as deletion proofs. Responses are gzipped by
+        the phone, the base transport already asks for that.
+    """
+    encode_threshold = 1400
+
 class Phone:
-    def __init__(self, url):
+    def __init__(self, url, data_url):
         self.url = url
-        self.client = xmlrpc.client.ServerProxy(url, allow_none=True)
-
-    def __getattr__(self, name, **kwargs):
-        if hasattr(self.client, name):
-            return getattr(self.client, name, **kwargs)
+        self.data_url = urllib.parse.urlsplit(data_url)
+        # Neither the ServerProxy nor the http connection is thread safe, each thread gets its own.
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        if not hasattr(self._local, "client"):
+            # Builtin types make binary data arrive as bytes instead of wrapped in Binary.
+            transport = GzipTransport(use_builtin_types=True)
+            self._local.client = xmlrpc.client.ServerProxy(self.url, transport=transport, allow_none=True)
+            self._local.methods = {}
+        return self._local.client
+
+    def __getattr__(self, name):
+        # ServerProxy creates a new method object on every lookup, keep them around instead. They
+        # belong to this thread's proxy, so they are cached per thread.
+        client = self.client
+        method = self._local.methods.get(name)
+        if method is None:
+            method = self._local.methods[name] = getattr(client, name)
+        return method
+
+    def _data_request(self, path):
+        # The connection is kept alive between assets, reconnect once if the phone dropped it.
+        for attempt in range(2):
+            if getattr(self._local, "data_connection", None) is None:
+                self._local.data_connection = http.client.HTTPConnection(self.data_url.netloc)
+            try:
+                self._local.data_connection.request("GET", path)
+                return self._local.data_connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                self._local.data_connection.close()
+                self._local.data_connection = None
+                if attempt:
+                    raise
+
+    def stream_asset(self, local_id):
+        """
+            Stream the raw data of an asset from the data server, yields chunks.
+        """
+        path = self.data_url.path.rstrip("/") + "/asset/" + urllib.parse.quote(local_id, safe="")
+        response = self._data_request(path)
+        if response.status != 200:
+            response.read()
+            raise BaseException(f"Retrieving data of {local_id} failed: {response.status} {response.reason}")
+        while chunk := response.read(CHUNK_SIZE):
+            yield chunk
+
+class MetadataCache:
+    """
+        Local copy of the metadata of the assets on the phone, such that only the metadata of new
+        or modified assets needs to be serialized by the phone on every sync. Everything is keyed
+        by the phone's url, such that multiple phones can share one cache.
+    """
+    def __init__(self, path):
+        # A bare filename lives in the current directory, which exists already.
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS assets(phone TEXT, local_id TEXT, mtime REAL, json BLOB, "
+                        "PRIMARY KEY (phone, local_id))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS refresh(phone TEXT PRIMARY KEY, time REAL, ordered BLOB)")
+
+    def get_all_metadata(self, p, batch_size, ttl=0):
+        """
+            Equivalent of the phone's get_all_metadata, served from the cache where possible. If
+            the cache was refreshed less than ttl seconds ago the phone isn't asked at all.
+        """
+        phone = p.url
+        if ttl > 0:
+            row = self.db.execute("SELECT time, ordered FROM refresh WHERE phone = ?", (phone,)).fetchone()
+            if row is not None:
+                refreshed, ordered = row
+                age = time.time() - refreshed
+                if age < ttl:
+                    logger.info(f"Metadata cache: refreshed {age:.0f}s ago, not asking the phone")
+                    return self._load(phone, loads_json(ordered))
+
+        on_phone = p.list_ids_and_mtimes()
+        cached = dict(self.db.execute("SELECT local_id, mtime FROM assets WHERE phone = ?", (phone,)))
+
+        stale = [local_id for local_id, mtime in on_phone if cached.get(local_id) != mtime]
+        logger.info(f"Metadata cache: {len(on_phone) - len(stale)} cached, {len(stale)} to retrieve")
+        for i in range(0, len(stale), batch_size):
+            metadata = p.get_metadata_by_local_ids(stale[i:i + batch_size])
+            self.db.executemany("INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?)",
+                                [(phone, m["local_id"], m["modification_date"], dumps_json(m)) for m in metadata])
+
+        # Forget about assets that are no longer on the phone.
+        gone = cached.keys() - {local_id for local_id, _ in on_phone}
+        self.db.executemany("DELETE FROM assets WHERE phone = ? AND local_id = ?", [(phone, local_id) for local_id in gone])
+        ordered = [local_id for local_id, _ in on_phone]
+        self.db.execute("INSERT OR REPLACE INTO refresh VALUES (?, ?, ?)", (phone, time.time(), dumps_json(ordered)))
+        self.db.commit()
+
+        return self._load(phone, ordered)
+
+    def _load(self, phone, ordered):
+        rows = dict(self.db.execute("SELECT local_id, json FROM assets WHERE phone = ?", (phone,)))
+        return [loads_json(rows[local_id]) for local_id in ordered]
 
 class Storage:
-    def __init__(self, dir, path, metadata_path):
+    def __init__(self, dir, path, metadata_path, verify_on_disk=False):
         self.dir = dir
         self.path = path
         self.metadata_path = metadata_path
+        self._path_format = compile_format(path)
+        self._metadata_path_format = compile_format(metadata_path)
+        self.verify_on_disk = verify_on_disk
+        # Parsed metadata files by path, for the duration of this run.
+        self._metadata = {}
+        # Directories that are known to exist, such that they are only created once per run.
+        self._ensured_dirs = set()
+        # Index of what was synced by local_id, avoids reading each metadata file on every run.
+        self._index_path = os.path.join(dir, INDEX_FILENAME)
+        self._index = self._load_index(self._index_path)
+        self._index_dirty = False
+
+    @staticmethod
+    def _load_index(index_path):
+        try:
+            return load_json(index_path)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # It is only a cache, the metadata files themselves are authoritative.
+            logger.warning(f"Ignoring unreadable index {index_path}")
+            return {}
+
+    def _update_index(self, local_id, **entry):
+        """
+            Record what is on disk for this asset, entries always hold the modification_date and
+            may hold the size, mtime_ns and md5 of the data file.
+        """
+        if self._index.get(local_id) != entry:
+            self._index[local_id] = entry
+            self._index_dirty = True
+
+    def write_index(self):
+        """
+            Write the index if it changed, through a temporary file such that it is never torn.
+        """
+        if not self._index_dirty:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self._index_path + ".tmp"
+        dump_json(tmp_path, self._index)
+        os.replace(tmp_path, self._index_path)
+        self._index_dirty = False
+
+    def _ensure_dir(self, d):
+        if d not in self._ensured_dirs:
+            os.makedirs(d, exist_ok=True)
+            self._ensured_dirs.add(d)
+
+    def read_metadata(self, path_to_metadata):
+        if path_to_metadata not in self._metadata:
+            self._metadata[path_to_metadata] = load_json(path_to_metadata)
+        return self._metadata[path_to_metadata]
 
     @staticmethod
     def metadata_for_path(asset):
-        import copy
-        z = copy.copy(asset)
-        formats = ("Y", "m")
-        for (suffix, key) in (("create", "creation_date"), ("mod", "modification_date")):
-            t = asset[key]
-            for f in formats:
-                z[f + "_" + suffix] = datetime.datetime.utcfromtimestamp(t).strftime('%'+f)
-        return z
-
-    def get_path(self, asset):
-        m = self.metadata_for_path(asset)
-        return os.path.join(self.dir, self.path.format(**m))
+        return {**asset, **path_date_keys(asset["creation_date"], asset["modification_date"])}
 
     def get_metadata_path(self, asset):
+        return self._format_metadata_path(self.metadata_for_path(asset))
+
+    def get_paths(self, asset):
+        """
+            Return both (path, metadata_path), computing the path metadata only once.
+        """
         m = self.metadata_for_path(asset)
-        p = Path(os.path.join(self.dir, self.metadata_path.format(**m)))
-        return p.with_suffix('.json')
+        return self._format_path(m), self._format_metadata_path(m)
 
-    def files_to_sync(self, on_phone):
-        to_sync = []
-        for asset in on_phone:
-            path_to_metadata = self.get_metadata_path(asset)
-            if not os.path.isfile(path_to_metadata):
-                logger.debug(f'Syncing {asset["local_id"]} because missing.')
-                to_sync.append(asset)
-                continue
+    def _format_path(self, m):
+        return os.path.join(self.dir, self._path_format(m))
 
-            # The file exists, check if modified date is the same.
-            with open(path_to_metadata) as f:
-                data = json.load(f)
+    def _format_metadata_path(self, m):
+        p = Path(os.path.join(self.dir, self._metadata_path_format(m)))
+        return p.with_suffix('.json')
 
-            if data["modification_date"] != asset["modification_date"]:
-                logger.debug(f'Syncing {asset["local_id"]} modification_date differs.')
-                to_sync.append(asset)
+    def _read_modification_date(self, path_to_metadata):
+        """
+            Read the modification date from a metadata file, metadata files are written with it as
+            the first key, so only the start of the file needs to be read and parsed.
+        """
+        if path_to_metadata not in self._metadata:
+            with open(path_to_metadata, "rb") as f:
+                match = MODIFICATION_DATE_PREFIX.match(f.read(64))
+            if match:
+                return float(match.group(1))
+        # Metadata files written by older versions, fall back to parsing all of it.
+        return self.read_metadata(path_to_metadata)["modification_date"]
+
+    def _needs_sync(self, asset, path_to_metadata):
+        """
+            Return the asset if its metadata file on disk shows it needs to be synced, None
+            otherwise.
+        """
+        try:
+            modification_date = self._read_modification_date(path_to_metadata)
+        except FileNotFoundError:
+            logger.debug('Syncing %s because removed since listing.', asset["local_id"])
+            return asset
+        if modification_date != asset["modification_date"]:
+            logger.debug('Syncing %s modification_date differs.', asset["local_id"])
+            return asset
+        self._update_index(asset["local_id"], modification_date=modification_date)
+
+        # nothing to do!
+        logger.debug('Skipping %s already got it.', asset["local_id"])
+        return None
+
+    def _existing_files(self, dirs):
+        """
+            Return the paths of all files in these directories, one scandir per directory instead
+            of a stat per file. Directories found are remembered as existing.
+        """
+        existing = set()
+        for d in dirs:
+            try:
+                with os.scandir(d) as entries:
+                    existing.update(entry.path for entry in entries if entry.is_file())
+            except FileNotFoundError:
                 continue
+            self._ensured_dirs.add(d)
+        return existing
 
-            # nothing to do!
-            logger.debug(f'Skipping {asset["local_id"]} already got it.')
-        return to_sync
-
-    def load_from_disk(self, asset):
-        path_to_metadata = self.get_metadata_path(asset)
-        with open(path_to_metadata) as f:
-            data = json.load(f)
+    def files_to_sync(self, on_phone):
+        metadata_paths = [self.get_metadata_path(asset) for asset in on_phone]
+        existing = self._existing_files({os.path.dirname(p) for p in metadata_paths})
+
+        # Only the metadata files that the index doesn't vouch for have to be read, that is latency
+        # bound on the filesystem, so do it from a bunch of threads. No threads are started if
+        # nothing has to be read.
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            needs_sync = []
+            for asset, path_to_metadata in zip(on_phone, metadata_paths):
+                if str(path_to_metadata) not in existing:
+                    logger.debug('Syncing %s because missing.', asset["local_id"])
+                    needs_sync.append(asset)
+                elif self._index.get(asset["local_id"], {}).get("modification_date") == asset["modification_date"]:
+                    logger.debug('Skipping %s already got it.', asset["local_id"])
+                else:
+                    needs_sync.append(executor.submit(self._needs_sync, asset, path_to_metadata))
+            needs_sync = [a.result() if isinstance(a, Future) else a for a in needs_sync]
+            return [a for a in needs_sync if a]
+
+    def load_from_disk(self, asset, metadata_only=False):
+        get_path, path_to_metadata = self.get_paths(asset)
+        data = dict(self.read_metadata(path_to_metadata))
+
+        # We got the metadata, now add the filesize, also when only the metadata is checked, such
+        # that the phone never deletes an asset whose data we don't have.
+        try:
+            st = os.stat(get_path)
+        except FileNotFoundError:
+            raise BaseException(f"Data file {get_path} is missing for {asset['local_id']}.")
+        data["_filesize"] = st.st_size
+        if metadata_only:
+            return data
+
+        # Check the size before hashing, if the file doesn't match what we stored there's no
+        # point in reading all of it.
+        indexed = self._index.get(asset["local_id"], {})
+        if indexed.get("modification_date") != data["modification_date"]:
+            indexed = {}
+        if "size" in indexed and st.st_size != indexed["size"]:
+            raise BaseException(f"File size on disk incorrect for {get_path}, got {st.st_size}, expected {indexed['size']}.")
+
+        if indexed.get("mtime_ns") == st.st_mtime_ns and "md5" in indexed:
+            # Unchanged since we hashed it, no need to read it again.
+            data["_md5"] = indexed["md5"]
+            return data
 
-        # We got the metadata, now add the filesize and md5sum.
-        get_path = self.get_path(asset)
-        # Read it back to obtain the md5.
         with open(get_path, "rb") as f:
-            z = f.read()
-
-        # calculate the hash.
-        import hashlib
-        m = hashlib.md5()
-        m.update(z)
-        h = m.hexdigest()
-
-        data["_filesize"] = len(z)
-        data["_md5"] = h
+            data["_md5"] = md5_of_file(f)
+        self._update_index(asset["local_id"], modification_date=data["modification_date"],
+                           size=st.st_size, mtime_ns=st.st_mtime_ns, md5=data["_md5"])
         return data
         
 
-    def retrieve(self, p, asset):
-        get_path = self.get_path(asset)
-        path_to_metadata = self.get_metadata_path(asset)
-        logger.debug(f'Retrieving id: {asset["local_id"]} modified at {asset["modification_date"]}')
-        retrieved = p.retrieve_asset_by_local_id(asset["local_id"])
-        logger.debug(f'  Retrieved {len(retrieved["_data"].data)} bytes')
-
-        # Ensure directories exist.
-        os.makedirs(os.path.dirname(get_path), exist_ok=True)
-        os.makedirs(os.path.dirname(path_to_metadata), exist_ok=True)
-
-        # Next, write the actual data.
-        with open(get_path, "wb") as f:
-            f.write(retrieved["_data"].data)
-
-        # Read it back to obtain the md5.
-        with open(get_path, "rb") as f:
-            z = f.read()
+    def retrieve_all(self, p, assets, batch_size, prefetch):
+        """
+            Retrieve assets in batches, yields the retrieved metadata of each asset in order.
+            The metadata of up to prefetch batches ahead is requested from another thread. The
+            phone loads the data of the next prepared asset while the current one is being sent,
+            so preparing ahead also lets the last asset of a batch overlap with the next batch.
+        """
+        batches = [assets[i:i + batch_size] for i in range(0, len(assets), batch_size)]
+        pending = collections.deque()
+        # The reader is a single thread, such that it keeps reusing its connection to the phone.
+        with ThreadPoolExecutor(max_workers=1) as executor, ThreadPoolExecutor(max_workers=1) as reader:
+            for batch in batches:
+                pending.append((batch, executor.submit(self._fetch_metadata, p, batch)))
+                if len(pending) > prefetch:
+                    batch, metadata = pending.popleft()
+                    yield from self._store_batch(p, batch, metadata.result(), reader)
+            while pending:
+                batch, metadata = pending.popleft()
+                yield from self._store_batch(p, batch, metadata.result(), reader)
 
+    @staticmethod
+    def _fetch_metadata(p, assets):
+        logger.debug(f'Retrieving metadata for {len(assets)} assets.')
+        return p.prepare_many_retrievals([asset["local_id"] for asset in assets])
+
+    def _store_batch(self, p, assets, metadata, reader=None):
+        written = []
+        for asset, retrieved in zip(assets, metadata):
+            chunks = p.stream_asset(asset["local_id"])
+            if reader is not None:
+                chunks = self._read_ahead(reader, chunks)
+            written.append(self._write_data(asset, chunks))
+
+        # The phone hashed the data while sending it, obtain its results for the entire batch in a
+        # single round trip.
+        final = p.finalize_many_retrievals([asset["local_id"] for asset in assets])
+        for asset, retrieved, (size, h), digest in zip(assets, metadata, written, final):
+            retrieved.update(digest)
+            yield self._store(asset, retrieved, size, h)
 
-        logger.debug(f'  Data size: {len(z)}')
-        logger.debug(f'  _filesize: {retrieved["_filesize"]}')
+    @staticmethod
+    def _read_ahead(reader, chunks):
+        """
+            Pull chunks on the reader thread into a bounded queue, such that receiving the next
+            chunk from the network overlaps with writing and hashing the current one.
+        """
+        q = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if stop.is_set():
+                        return
+                    q.put(chunk)
+            except BaseException as e:
+                q.put(e)
+                return
+            q.put(None)
+
+        future = reader.submit(produce)
+        try:
+            while (item := q.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # If we bailed out early, unblock the producer so the reader thread is freed.
+            stop.set()
+            while not future.done():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _write_data(self, asset, chunks):
+        """
+            Write the chunks making up the asset to disk, hashing them as they are written.
+            Returns the (size, md5) of what was written.
+        """
+        get_path, path_to_metadata = self.get_paths(asset)
+        logger.debug('Retrieving id: %s modified at %s', asset["local_id"], asset["modification_date"])
 
-        if len(z) != retrieved["_filesize"]:
-            raise BaseException(f"File size incorrect for {get_path}, expected {len(z)}.")
+        # Ensure directories exist.
+        self._ensure_dir(os.path.dirname(get_path))
+        self._ensure_dir(os.path.dirname(path_to_metadata))
 
-        import hashlib
+        # Next, write the actual data, hashing it as it is written.
         m = hashlib.md5()
-        m.update(z)
-        h = m.hexdigest()
+        size = 0
+        # Close the chunks when bailing out, such that the read ahead stops and frees its thread.
+        # Otherwise the traceback keeps the generator alive and the reader blocks forever.
+        with contextlib.closing(chunks), open(get_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                m.update(chunk)
+                size += len(chunk)
+            if hasattr(os, "posix_fadvise") and not self.verify_on_disk:
+                # We're not going to read it back, don't let it push everything else out of the
+                # page cache. This also starts the writeback of the data.
+                f.flush()
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        return size, m.hexdigest()
+
+    def _store(self, asset, retrieved, size, h):
+        """
+            Verify the written data against the size and md5 the phone reported, and write the
+            metadata if it matches.
+        """
+        get_path, path_to_metadata = self.get_paths(asset)
+        logger.debug('Verifying id: %s', asset["local_id"])
+        logger.debug('  Data size: %s', size)
+        logger.debug('  _filesize: %s', retrieved["_filesize"])
+
+        if size != retrieved["_filesize"]:
+            raise BaseException(f"File size incorrect for {get_path}, got {size}, expected {retrieved['_filesize']}.")
+
         expected = retrieved["_md5"]
 
-        logger.debug(f'   md5: {h}')
-        logger.debug(f'  _md5: {retrieved["_md5"]}')
+        logger.debug('   md5: %s', h)
+        logger.debug('  _md5: %s', retrieved["_md5"])
 
         if h != expected:
             raise BaseException(f"Md5 does not match! Got {h} for {get_path}, expected {expected}")
 
-        # we got here, file retrieved correctly, write the metadata
-        clean_metadata = {k:v for k, v in retrieved.items() if not k.startswith("_")}
+        if self.verify_on_disk:
+            # Paranoid mode, read the file back to check what actually ended up on disk.
+            with open(get_path, "rb") as f:
+                h = md5_of_file(f)
+            logger.debug('  disk md5: %s', h)
+            if h != expected:
+                raise BaseException(f"Md5 on disk does not match! Got {h} for {get_path}, expected {expected}")
+
+        # we got here, file retrieved correctly, write the metadata, modification_date goes first
+        # such that files_to_sync only has to read the start of the file.
+        clean_metadata = {"modification_date": retrieved["modification_date"]}
+        clean_metadata.update((k, v) for k, v in retrieved.items() if not k.startswith("_"))
 
         
-        logger.debug(f'  Writing metadata.')
-        with open(path_to_metadata, "w") as f:
-            json.dump(clean_metadata, f)
+        logger.debug('  Writing metadata.')
+        dump_json(path_to_metadata, clean_metadata)
+        self._metadata[path_to_metadata] = clean_metadata
+        st = os.stat(get_path)
+        self._update_index(asset["local_id"], modification_date=clean_metadata["modification_date"],
+                           size=st.st_size, mtime_ns=st.st_mtime_ns, md5=expected)
 
         return retrieved
 
 def run_sync(args):
     logger.info(f'Running sync.')
     logger.debug(f' host: {args.host}')
+    logger.debug(f' data_host: {args.data_host}')
     logger.debug(f' dir: {args.dir}')
     logger.debug(f' path: {args.path}')
     logger.debug(f' metadata_path: {args.metadata_path}')
-
-    p = Phone(args.host)
-    sync = Storage(dir=args.dir, path=args.path, metadata_path=args.metadata_path)
-    on_phone = p.get_all_metadata()
+    logger.debug(f' batch_size: {args.batch_size}')
+    logger.debug(f' prefetch: {args.prefetch}')
+    logger.debug(f' metadata_cache: {args.metadata_cache}')
+    logger.debug(f' metadata_ttl: {args.metadata_ttl}')
+    logger.debug(f' verify_on_disk: {args.verify_on_disk}')
+
+    p = Phone(args.host, args.data_host)
+    sync = Storage(dir=args.dir, path=args.path, metadata_path=args.metadata_path,
+                   verify_on_disk=args.verify_on_disk)
+    if args.metadata_cache:
+        cache = MetadataCache(os.path.expanduser(args.metadata_cache))
+        on_phone = cache.get_all_metadata(p, args.batch_size, args.metadata_ttl)
+    else:
+        on_phone = p.get_all_metadata()
 
     logger.info(f"On phone: {len(on_phone)}")
     to_sync = sync.files_to_sync(on_phone)
     logger.info(f"To sync : {len(to_sync)}")
     total = len(to_sync)
-    for i, asset in enumerate(to_sync):
-        retrieved = sync.retrieve(p, asset)
-        filename = retrieved["filename"]
-        size = retrieved["_filesize"]
-        date =  datetime.datetime.utcfromtimestamp(retrieved["creation_date"]).strftime('%Y-%m-%d %H:%M:%S')
-        logger.info(f"{i+1: >5} / {total: >5}: {filename: >20} {date} ({size: >9} bytes)")
+    retrieved_assets = sync.retrieve_all(p, to_sync, args.batch_size, args.prefetch)
+    try:
+        for i, retrieved in enumerate(retrieved_assets):
+            filename = retrieved["filename"]
+            size = retrieved["_filesize"]
+            date =  datetime.datetime.utcfromtimestamp(retrieved["creation_date"]).strftime('%Y-%m-%d %H:%M:%S')
+            logger.info(f"{i+1: >5} / {total: >5}: {filename: >20} {date} ({size: >9} bytes)")
+    finally:
+        # Also keep what was stored before things went wrong.
+        sync.write_index()
 
 def run_test(args):
-    p = Phone(args.host)
+    p = Phone(args.host, args.data_host)
     print(p.client.get_asset_collections())
     metadata = p.client.get_all_metadata()
     
@@ -181,40 +610,31 @@ def run_delete(args):
     logger.debug(f' path: {args.path}')
     logger.debug(f' metadata_path: {args.metadata_path}')
     logger.debug(f' retain_duration: {args.retain_duration}')
-    p = Phone(args.host)
+    logger.debug(f' metadata_only: {args.metadata_only}')
+    p = Phone(args.host, args.data_host)
     sync = Storage(dir=args.dir, path=args.path, metadata_path=args.metadata_path)
 
-    # Obtain whatever we have on the phone.
+    # Obtain whatever we have on the phone and all asset collections, in a single round trip.
     logger.info(f'Obtaining metadata from phone.')
-    on_phone = p.get_all_metadata()
+    multicall = xmlrpc.client.MultiCall(p.client)
+    multicall.get_all_metadata()
+    multicall.get_asset_collections()
+    on_phone, asset_collections = multicall()
     logger.info(f'Total assets: {len(on_phone)}')
 
-    # Obtain all asset collections.
-    asset_collections = p.client.get_asset_collections()
-
     # We're only interested in manually created albums.
     manual_albums = asset_collections["albums"]
 
     # Collect all photos that are part of a manual album, they are always preserved.
-    keep_photos = set()
-    for album in manual_albums:
-        for asset in album["assets"]:
-            keep_photos.add(asset["local_id"])
+    keep_photos = {asset["local_id"] for album in manual_albums for asset in album["assets"]}
     logger.info(f'Assets in albums: {len(keep_photos)}')
 
-    to_prune = []
     # Next, we can iterate through the photos on the phone, check against expiry.
-    now = time.time()
-    for asset in on_phone:
-        staleness = now - asset["modification_date"]
-        logger.debug(f'Considering {asset["local_id"]} with age {staleness} seconds.')
-        if staleness >= args.retain_duration:
-            logger.debug(f'  is older than retain')
-            if asset["local_id"] in keep_photos:
-                logger.debug(f"  Preserving {asset['local_id']}  {asset['filename']} because in keep.")
-            if asset["local_id"] not in keep_photos:
-                logger.debug(f"  {asset['filename']} marking for deletion")
-                to_prune.append(asset)
+    # Anything last modified at or before the cutoff is older than the retain duration.
+    cutoff = time.time() - args.retain_duration
+    expired = [asset for asset in on_phone if asset["modification_date"] <= cutoff]
+    to_prune = [asset for asset in expired if asset["local_id"] not in keep_photos]
+    logger.debug(f'Expired: {len(expired)}, preserving {len(expired) - len(to_prune)} because in keep.')
 
     logger.info(f'To prune: {len(to_prune)}')
 
@@ -222,16 +642,17 @@ def run_delete(args):
     # the photo and metadata.
 
     logger.info(f'Calculating proof we have asset marked for deletion.')
-    to_prune_proof = []
-    for asset in to_prune:
-        to_prune_proof.append(sync.load_from_disk(asset))
+    # Hashing releases the GIL, so the files can be hashed on all cores from threads.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        to_prune_proof = list(executor.map(sync.load_from_disk, to_prune, itertools.repeat(args.metadata_only)))
+    sync.write_index()
     logger.info(f'Obtained {len(to_prune_proof)} proofs.')
 
     # Now that we have assembled our proof, we can _finally_ tell the phone to remove these entries.
     # print(to_prune_proof)
 
     logger.info(f'Issuing deletion, phone will check proof and prompt.')
-    p.delete_assets_by_metadata(to_prune_proof, args.ignore_integrity)
+    p.delete_assets_by_metadata(to_prune_proof, args.ignore_integrity, args.metadata_only)
     logger.info(f'Done.')
     
     
@@ -242,6 +663,7 @@ if __name__ == "__main__":
                         "nothing is warn/error only, -v is info, -vv is debug.")
 
     parser.add_argument("--host", default="http://$REPL_HOST:1338", help="xmlrpc interface to connect to. Defaults to %(default)s")
+    parser.add_argument("--data-host", default=None, help=f"Server to retrieve asset data from. Defaults to port {DATA_PORT} on the host of --host")
     subparsers = parser.add_subparsers(dest="command")
 
     test_parser = subparsers.add_parser('test')
@@ -255,6 +677,14 @@ if __name__ == "__main__":
 
     sync_parser = subparsers.add_parser('sync')
     add_storage_args(sync_parser)
+    sync_parser.add_argument("--batch-size", default=32, type=int, help="Number of assets to request per round trip. Default: %(default)s")
+    sync_parser.add_argument("--prefetch", default=1, type=int, help="Number of batches to request ahead of the one being written. Default: %(default)s")
+    sync_parser.add_argument("--metadata-cache", default="~/.cache/photo_sync/index.sqlite",
+                             help="Local cache of the phone's metadata, empty to disable. Default: %(default)s")
+    sync_parser.add_argument("--metadata-ttl", default=0, type=float,
+                             help="Seconds for which the metadata cache is used without asking the phone what changed. Default: %(default)s")
+    sync_parser.add_argument("--verify-on-disk", default=False, action="store_true",
+                             help="Read every written file back to verify its md5 on disk.")
     sync_parser.set_defaults(func=run_sync)
 
     def sane_date_parser(v):
@@ -283,6 +713,8 @@ if __name__ == "__main__":
     add_storage_args(delete_parser)
     delete_parser.add_argument("--retain-duration", default="30d", type=sane_date_parser, help="Duration to keep. Default: %(default)s, d=day, w=week, m=month")
     delete_parser.add_argument("--ignore-integrity", default=False, action="store_true", help="Skip the integrity check.")
+    delete_parser.add_argument("--metadata-only", default=False, action="store_true",
+                               help="Only prove the metadata and file size, skips hashing the files on both sides.")
     delete_parser.set_defaults(func=run_delete)
 
     args = parser.parse_args()
@@ -302,6 +734,13 @@ if __name__ == "__main__":
 
     if "REPL_HOST" in os.environ:
         args.host = args.host.replace("$REPL_HOST", os.environ["REPL_HOST"])
+        if args.data_host is not None:
+            args.data_host = args.data_host.replace("$REPL_HOST", os.environ["REPL_HOST"])
+
+    if args.data_host is None:
+        host = urllib.parse.urlsplit(args.host)
+        netloc = host.netloc if host.port is None else host.netloc.rpartition(":")[0]
+        args.data_host = urllib.parse.urlunsplit((host.scheme, f"{netloc}:{DATA_PORT}", "", "", ""))
 
     # no command
     if (args.command is None):